@@ -3,6 +3,8 @@ import pandas as pd
 import re
 import math
 import hashlib
+import html
+import orjson
 import requests
 from io import BytesIO
 from PIL import Image as PILImage
@@ -16,6 +18,7 @@ from reportlab.lib import colors
 from reportlab.lib.units import inch
 import tempfile
 import os
+import time
 from datetime import datetime, timedelta
 import gspread
 from gspread_dataframe import get_as_dataframe, set_with_dataframe
@@ -58,17 +61,23 @@ def init_session_state():
         "pdf_data": [],          
         "cart": [],              
         "edit_mode": False,      
+        "last_pdf": {},
     }
     for key, default_value in defaults.items():
         if key not in st.session_state:
             st.session_state[key] = default_value
 init_session_state()
 
+@st.cache_resource(show_spinner=False)
+def get_gspread_client():
+    """Authorize the service account once and share the client across sheets"""
+    return gspread.service_account_from_dict(st.secrets["gcp_service_account"])
+
 @st.cache_data(ttl=300)  # Cache for 5 minutes
 def load_users_from_sheet():
     """Load user credentials from Google Sheet by name (not ID)"""
     try:
-        gc = gspread.service_account_from_dict(st.secrets["gcp_service_account"])
+        gc = get_gspread_client()
         # 🔓 Open by spreadsheet name (must be shared with service account email)
         sh = gc.open("Amjad's users")  # ← Spreadsheet name
         worksheet = sh.sheet1  # Assumes user data is in first sheet
@@ -123,7 +132,7 @@ USERS = load_users_from_sheet()
 @st.cache_resource
 def get_company_sheet():
     try:
-        gc = gspread.service_account_from_dict(st.secrets["gcp_service_account"])
+        gc = get_gspread_client()
         sh = gc.open("clients Db")
         return sh.sheet1
     except gspread.SpreadsheetNotFound:
@@ -206,12 +215,12 @@ def save_company_to_sheet(sheet, company_data):
         st.error(f"❌ Failed to save company: {e}")
         return False
 # ========== Connect to Quotation History Sheet ==========
-@st.cache_resource
+@st.cache_resource(show_spinner=False)
 def get_history_sheet():
     # Cache the connection to the history Google Sheet
     # Returns the first worksheet of "Amjad's history" spreadsheet
     try:
-        gc = gspread.service_account_from_dict(st.secrets["gcp_service_account"])
+        gc = get_gspread_client()
     
         sh = gc.open("Amjad's history")  
         return sh.sheet1
@@ -244,16 +253,16 @@ def load_user_history(user_email, sheet):
         history = []
         for _, row in user_rows.iterrows():
             try:
-                items = json.loads(row["Items JSON"])
+                items = orjson.loads(row["Items JSON"])
                 company_details_raw = row.get("Company Details JSON", "{}")
                 try:
-                    company_details = json.loads(company_details_raw) if pd.notna(company_details_raw) and company_details_raw.strip() != "" else {}
+                    company_details = orjson.loads(company_details_raw) if pd.notna(company_details_raw) and company_details_raw.strip() != "" else {}
                 except:
                     company_details = {}
                 stored_hash = str(row.get("Quotation Hash", "")).strip()
                 if not stored_hash or stored_hash.lower() in ("nan", ""):
                     fallback_data = f"{row['Company Name']}{row['Timestamp']}{row['Total']}"
-                    stored_hash = hashlib.md5(fallback_data.encode()).hexdigest()
+                    stored_hash = hashlib.blake2b(fallback_data.encode(), digest_size=16, usedforsecurity=False).hexdigest()
                 history.append({
                     "user_email": row["User Email"],
                     "timestamp": row["Timestamp"],
@@ -519,32 +528,67 @@ def get_sheet_data(_worksheets):
         st.error(traceback.format_exc())
         return None
 
-def load_user_history_from_sheet(user_email, sheet):
-    """Load user's quotation history from Google Sheet"""
-    if sheet is None:
+def parse_json_cell(value):
+    """Parse a JSON cell from the history sheet, returning None for blank or malformed text"""
+    if not isinstance(value, str) or not value.strip():
+        return None
+    try:
+        return orjson.loads(value)
+    except ValueError:
+        return None
+
+def history_record_from_row(row):
+    """Turn one history sheet row (header -> cell text) into a history record, or None if malformed"""
+    items = parse_json_cell(row.get("Items JSON"))
+    if items is None:
+        return None
+    try:
+        total = float(str(row.get("Total", "")).replace(",", ""))
+    except ValueError:
+        return None
+
+    # 🔐 Generate a deterministic fallback hash if none is stored
+    stored_hash = str(row.get("Quotation Hash", "")).strip()
+    if not stored_hash or stored_hash.lower() == "nan":
+        fallback_data = f"{row.get('Company Name', '')}{row.get('Timestamp', '')}{row.get('Total', '')}"
+        stored_hash = hashlib.blake2b(fallback_data.encode(), digest_size=16, usedforsecurity=False).hexdigest()
+
+    return {
+        "user_email": row.get("User Email", ""),
+        "timestamp": row.get("Timestamp", ""),
+        "company_name": row.get("Company Name", ""),
+        "contact_person": row.get("Contact Person", ""),
+        "total": total,
+        "items": items,
+        "pdf_filename": row.get("PDF Filename", ""),
+        "hash": stored_hash,  # Always ensure this exists
+        "company_details": parse_json_cell(row.get("Company Details JSON")) or {}
+    }
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_user_history_from_sheet(user_email, _sheet):
+    """Load user's quotation history from Google Sheet with fallbacks (cached per user for 60s)"""
+    if _sheet is None:
         return []
     try:
-        df = get_as_dataframe(sheet)
-        df.dropna(how='all', inplace=True)  
-        user_rows = df[df["User Email"].str.lower() == user_email.lower()]
+        # One API call for the raw cell text; no DataFrame needed for a per-user filter
+        values = _sheet.get_all_values()
+        if not values:
+            return []
+        headers = [h.strip() for h in values[0]]
+        email_idx = headers.index("User Email")
+        user_email = user_email.lower()
+
         history = []
-        import json
-        for _, row in user_rows.iterrows():
-            try:
-                items = json.loads(row["Items JSON"])
-                history.append({
-                    "user_email": row["User Email"],
-                    "timestamp": row["Timestamp"],
-                    "company_name": row["Company Name"],
-                    "contact_person": row["Contact Person"],
-                    "total": float(row["Total"]),
-                    "items": items,
-                    "pdf_filename": row["PDF Filename"],
-                    "hash": row["Quotation Hash"]
-                })
-            except Exception as e:
-                st.warning(f"⚠ Skipping malformed row: {e}")
+        for raw_row in values[1:]:
+            if len(raw_row) <= email_idx or raw_row[email_idx].strip().lower() != user_email:
+                continue
+            row = dict(zip(headers, raw_row))
+            record = history_record_from_row(row)
+            if record is None:
+                st.warning(f"⚠ Skipping malformed row (Company: {row.get('Company Name', 'Unknown')})")
                 continue
+            history.append(record)
         return history
     except Exception as e:
         st.error(f"❌ Failed to load history: {e}")
@@ -992,6 +1036,7 @@ if st.session_state.get('form_submitted', False):
             st.session_state.pdf_data = []
             st.session_state.selected_products = {}
             st.session_state.row_indices = [0]
+            st.session_state.last_pdf = {}
             st.success("🆕 New quotation started - all items cleared!")
             st.rerun()
 
@@ -1251,6 +1296,9 @@ for idx in st.session_state.row_indices:
     # If a product is selected, render details and compute totals
     if prod != "-- Select --":
         unit_price = price_map.get(prod, 0.0)
+        image_url = image_map.get(prod, "")
+        desc = desc_map.get(prod, "")
+        size = size_map.get(prod, "")
         qty = c6.number_input("", min_value=1, value=1, step=1, key=f"qty_{idx}", label_visibility="collapsed")
         discount = c7.number_input("", min_value=0.0, max_value=100.0, value=0.0, step=1.0, key=f"disc_{idx}", label_visibility="collapsed")
 
@@ -1260,16 +1308,12 @@ for idx in st.session_state.row_indices:
         if color_key not in st.session_state:
             st.session_state[color_key] = "Choose from In-Stock Colors"
 
-        if prod != "-- Select --":
-            user_color = c4.text_input(  
-                "Color",
-                value=st.session_state[color_key],
-                key=color_key,
-                label_visibility="collapsed"
-            )
-        else:
-            c4.write("—")
-            user_color = "Choose from In-Stock Colors"
+        user_color = c4.text_input(  
+            "Color",
+            value=st.session_state[color_key],
+            key=color_key,
+            label_visibility="collapsed"
+        )
 
         valid_discount = 0.0 if discount > 20 else discount
         if discount > 20:
@@ -1282,21 +1326,17 @@ for idx in st.session_state.row_indices:
         line_total = discounted_price * qty
 
         # Display image directly without download
-        image_url = image_map.get(prod, "")
         display_product_image(c3, prod, image_url)
 
         c5.write(f"{unit_price:.2f} SAR")
         c8.write(f"{line_total:.2f} SAR")
 
-        original_image_urls = lookups['image_map'].get(prod, "")
-
-       
         output_data.append({
             "Item": prod,
-            "Description": desc_map.get(prod, ""),          
-            "Size (mm)": size_map.get(prod, ""), 
+            "Description": desc,
+            "Size (mm)": size,
             "Color": user_color,                            
-            "Image": original_image_urls,
+            "Image": image_url,
             "Quantity": qty,
             "Price per item": unit_price,
             "Discount %": valid_discount,
@@ -1406,7 +1446,6 @@ overall_discount = st.number_input("🧮 Overall Quotation Discount (%)", min_va
 if overall_discount > 20:
     st.warning("⚠ Overall discount cannot exceed 20%. Ignoring discount.")
     overall_discount = 0.0
-basePrice = total_sum
 final_total = total_sum * (1 - overall_discount / 100)
 st.markdown(f"💰 *Total Before Discount: {total_sum:.2f} SAR")
 st.markdown(f"🔻 *Discount Applied: {overall_discount:.0f}%")
@@ -1421,25 +1460,101 @@ if output_data:
     st.dataframe(pd.DataFrame(output_data), use_container_width=True)
 
 # ========== PDF Generation Functions ==========
+MAX_IMAGE_BYTES = 5_000_000  # Skip product images larger than ~5 MB
+
+# Resized product images, shared with the history page. Files are named by
+# Drive file_id (or a hash of other URLs) and size, and expire after the TTL
+# so images replaced in place on Drive are picked up again
+IMAGE_CACHE_DIR = os.path.join(tempfile.gettempdir(), "amjad_pdf_images")
+IMAGE_CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+
+def image_cache_path(url, max_size):
+    """Cache file for a resized image: Drive file_id when there is one, else a hash of the URL"""
+    file_id = extract_file_id(url) if "drive.google.com" in str(url) else None
+    key = file_id or hashlib.sha1(str(url).encode()).hexdigest()
+    return os.path.join(IMAGE_CACHE_DIR, f"{key}_{max_size[0]}x{max_size[1]}.png")
+
+def is_image_cache_fresh(cache_path):
+    """True if the cached image exists and is younger than IMAGE_CACHE_TTL"""
+    try:
+        return time.time() - os.path.getmtime(cache_path) < IMAGE_CACHE_TTL
+    except OSError:
+        return False
+
+@st.cache_data(show_spinner=False)
+def get_pdf_image_size(path):
+    """Read a header/footer image's (width, height) once; drawImage gets the path so ReportLab embeds it once per PDF"""
+    if not path or not os.path.exists(path):
+        return None
+    with PILImage.open(path) as img:
+        return img.size
+
+@st.cache_resource
+def get_aligned_style():
+    """Left-aligned body text style shared by every quotation PDF"""
+    styles = getSampleStyleSheet()
+
+    # Base text style
+    styles['Normal'].fontSize = 14
+    styles['Normal'].leading = 20
+
+    return ParagraphStyle(
+        name='LeftAligned',
+        parent=styles['Normal'],
+        leftIndent=0,
+        firstLineIndent=0,
+        alignment=0,  # Left-aligned
+        spaceBefore=12,
+        spaceAfter=12
+    )
+
+@st.cache_resource
+def get_terms_style():
+    """12pt variant of the body style used for the Terms & Conditions block"""
+    return ParagraphStyle(name='Terms', parent=get_aligned_style(), fontSize=12)
+
+@st.cache_data(show_spinner=False)
+def build_terms_html(terms_text):
+    """Escape the T&C text and join its non-blank lines with <br/> (reruns only when the text changes)"""
+    escaped_terms = html.escape(terms_text)
+    stripped_lines = (line.strip() for line in escaped_terms.splitlines())
+    return "<br/>".join(line for line in stripped_lines if line)
+
 def download_image_for_pdf(url, max_size=(300, 300)):
     """Download and resize image for PDF with better error handling"""
+    # Bail out before any work when there is no usable link
+    if not url or not str(url).strip().lower().startswith("http"):
+        return None
+
     try:
-        if not url or url == "":
-            return None
-        
         # Handle multiple URLs
         if "|" in url:
             url = url.split("|")[0].strip()
+
+        # Reuse the resized copy from an earlier PDF if we have one
+        cache_path = image_cache_path(url, max_size)
+        if is_image_cache_fresh(cache_path):
+            return cache_path
         
         # Convert Google Drive URL if needed
         download_url = convert_google_drive_url_for_storage(url)
         
-        # Try to download
-        response = requests.get(download_url, timeout=10)
-        response.raise_for_status()
+        # Stream the download and give up on oversized files
+        buf = BytesIO()
+        with requests.get(download_url, timeout=10, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(65536):
+                if buf.tell() + len(chunk) > MAX_IMAGE_BYTES:
+                    print(f"Image too large, skipping: {url[:50]}")
+                    return None
+                buf.write(chunk)
+        buf.seek(0)
         
-        # Open and process image
-        img = PILImage.open(BytesIO(response.content))
+        # Open and process image (JPEGs are downscaled while decoding)
+        img = PILImage.open(buf)
+        img.draft('RGB', max_size)
+        img.load()
         
         # Convert to RGB if needed (handles PNG with alpha)
         if img.mode in ('RGBA', 'LA', 'P'):
@@ -1449,26 +1564,15 @@ def download_image_for_pdf(url, max_size=(300, 300)):
             background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
             img = background
         
-        # Resize while maintaining aspect ratio
-        img_ratio = img.width / img.height
-        max_width, max_height = max_size
+        # Shrink in place to fit max_size, keeping the aspect ratio
+        img.thumbnail(max_size, PILImage.Resampling.LANCZOS)
         
-        if img.width > max_width or img.height > max_height:
-            if img_ratio > 1:
-                # Wider than tall
-                new_width = max_width
-                new_height = int(max_width / img_ratio)
-            else:
-                # Taller than wide
-                new_height = max_height
-                new_width = int(max_height * img_ratio)
-            img = img.resize((new_width, new_height), PILImage.Resampling.LANCZOS)
-        
-        # Save as PNG
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
+        # Save as PNG, then move into place so readers never see a partial file
+        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png", dir=IMAGE_CACHE_DIR)
         img.save(temp_file, format="PNG")
         temp_file.close()
-        return temp_file.name
+        os.replace(temp_file.name, cache_path)
+        return cache_path
         
     except requests.exceptions.Timeout:
         print(f"Timeout downloading image: {url[:50]}")
@@ -1480,11 +1584,16 @@ def download_image_for_pdf(url, max_size=(300, 300)):
         print(f"Error processing image from {url[:50]}: {e}")
         return None
 
-@st.cache_data
-def build_pdf_cached(data_hash, final_total, company_details,
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False, max_entries=50)
+def build_pdf_cached(cache_key, _data, final_total, subtotal, _company_details,
                     hdr_path="amjad_quotation_header.png",
                     ftr_path="amjad_quotation_footer.png"):
     """
+    Only cache_key (a tuple of primitives built by the caller) and the
+    totals are hashed by st.cache_data; the underscore-prefixed data and
+    company details are passed through unhashed. Returns the PDF as bytes
+    so the cached value is self-contained (no temp file to clean up).
+
     Generate a professional quotation PDF with:
     - Terms & Conditions (image + text) moved BEFORE the items table
     - Page break after terms to force table to start on second page
@@ -1493,43 +1602,28 @@ def build_pdf_cached(data_hash, final_total, company_details,
     
     USE_TWO_IMAGES = False 
 
-    def build_pdf(data, total, company_details, hdr_path, ftr_path):
+    def build_pdf(data, total, subtotal, company_details, hdr_path, ftr_path):
         # Ensure data exists
         if not data:
             st.error("❌ No product data to generate PDF.")
             return None
 
-        # Create temporary PDF file
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-        pdf_path = tmp.name
-        tmp.close()
+        # Render into memory; the caller only needs the bytes
+        pdf_buffer = BytesIO()
 
         # Setup document with A3 size
         doc = SimpleDocTemplate(
-            pdf_path,
+            pdf_buffer,
             pagesize=A3,
             topMargin=250,
             leftMargin=45,
             rightMargin=45,
             bottomMargin=150
         )
-        styles = getSampleStyleSheet()
         elems = []
 
-        # Base text style
-        styles['Normal'].fontSize = 14
-        styles['Normal'].leading = 20
-
         # Left-aligned paragraph style
-        aligned_style = ParagraphStyle(
-            name='LeftAligned',
-            parent=styles['Normal'],
-            leftIndent=0,
-            firstLineIndent=0,
-            alignment=0,  # Left-aligned
-            spaceBefore=12,
-            spaceAfter=12
-        )
+        aligned_style = get_aligned_style()
 
         # ======================
         # Header & Footer Functions
@@ -1537,13 +1631,15 @@ def build_pdf_cached(data_hash, final_total, company_details,
         # ======================
         # First Page: Header + Footer
         # ======================
+        hdr_size = get_pdf_image_size(hdr_path)
+        ftr_size = get_pdf_image_size(ftr_path)
+
         def first_page(canvas, doc):
             canvas.saveState()
 
             # === Header (only on first page) ===
-            if hdr_path and os.path.exists(hdr_path):
-                img = PILImage.open(hdr_path)
-                w, h = img.size
+            if hdr_size:
+                w, h = hdr_size
                 page_w = doc.width + doc.leftMargin + doc.rightMargin
                 header_h = page_w * (h / w)
                 canvas.drawImage(
@@ -1558,9 +1654,8 @@ def build_pdf_cached(data_hash, final_total, company_details,
 
             # === Footer (on all pages) ===
             footer_y = 0
-            if ftr_path and os.path.exists(ftr_path):
-                img = PILImage.open(ftr_path)
-                w, h = img.size
+            if ftr_size:
+                w, h = ftr_size
                 page_w = doc.width + doc.leftMargin + doc.rightMargin
                 footer_h = page_w * (h / w)
                 canvas.drawImage(
@@ -1592,9 +1687,8 @@ def build_pdf_cached(data_hash, final_total, company_details,
 
             # === Footer only (no header) ===
             footer_y = 0
-            if ftr_path and os.path.exists(ftr_path):
-                img = PILImage.open(ftr_path)
-                w, h = img.size
+            if ftr_size:
+                w, h = ftr_size
                 page_w = doc.width + doc.leftMargin + doc.rightMargin
                 footer_h = page_w * (h / w)
                 canvas.drawImage(
@@ -1663,7 +1757,6 @@ def build_pdf_cached(data_hash, final_total, company_details,
         # Items Table
         # ======================
         product_table_data = [["Ser.", "Image", "Product", "Color", "Description", "QTY", "Price", "Total"]]
-        temp_files = []
 
         # Original total: 30 + 170 + 90 + 80 + 220 + 30 + 60 + 60 = 730
         # Remove "Color" (80) → redistribute: Image +50 → 220    , Description +30 → 250
@@ -1671,7 +1764,6 @@ def build_pdf_cached(data_hash, final_total, company_details,
         # Items Table with Section Headers (FIXED)
         # ======================
         product_table_data = [["Ser.", "Image", "Product", "Color", "Description", "QTY", "Price", "Total"]]
-        temp_files = []
 
         col_widths = [30, 220, 80, 60, 200, 40, 50, 50]
         total_table_width = sum(col_widths)
@@ -1701,6 +1793,29 @@ def build_pdf_cached(data_hash, final_total, company_details,
                 product_table_data.append(create_section_row(section['text'], color)) 
                 inserted_sections.add(sec_idx)
 
+        # Download every distinct image URL once, even when rows share a product
+        max_images = 2 if USE_TWO_IMAGES else 1
+
+        def row_image_urls(r):
+            image_urls = r.get("Image", "") or ""
+            return [url.strip() for url in image_urls.split("|") if url.strip()][:max_images]
+
+        image_path_by_url = {}
+        for r in data:
+            for url in row_image_urls(r):
+                if url in image_path_by_url:
+                    continue
+                try:
+                    image_path_by_url[url] = download_image_for_pdf(url, max_size=(300, 300))
+                except Exception as e:
+                    print(f"Error loading image: {e}")
+                    image_path_by_url[url] = None
+
+        # Cell styles shared by every product row
+        desc_style = ParagraphStyle('Desc', fontSize=11, leading=15, alignment=1, wordWrap='CJK')
+        styleN = ParagraphStyle('Center', fontSize=10, leading=17, alignment=1)
+        no_image_style = ParagraphStyle('NoImage', alignment=1, fontSize=10, textColor=colors.grey)
+
         # Now add product rows, inserting sections before appropriate products
         for idx, r in enumerate(data, start=1):
             # Insert section before this product if positioned after previous product
@@ -1719,22 +1834,8 @@ def build_pdf_cached(data_hash, final_total, company_details,
                         except:
                             pass
 
-          
-            image_urls = r.get("Image", "")
-            image_paths = []
-            
-            if image_urls:
-                urls = [url.strip() for url in image_urls.split("|") if url.strip()]
-                max_images = 2 if USE_TWO_IMAGES else 1
-                for url in urls[:max_images]:
-                    try:
-                        download_url = convert_google_drive_url_for_storage(url)
-                        temp_img_path = download_image_for_pdf(download_url, max_size=(300, 300))
-                        if temp_img_path:
-                            image_paths.append(temp_img_path)
-                            temp_files.append(temp_img_path)
-                    except Exception as e:
-                        print(f"Error loading image: {e}")
+
+            image_paths = [image_path_by_url[url] for url in row_image_urls(r) if image_path_by_url.get(url)]
 
             if image_paths:
                 total_img_width = 210
@@ -1752,21 +1853,21 @@ def build_pdf_cached(data_hash, final_total, company_details,
                     img_flowables.append(img)
                 
                 if len(img_flowables) == 1:
-                    img_table = Table([[img_flowables[0]]], colWidths=[total_img_width], hAlign='CENTER')
+                    # A single sized image centers itself in the cell
+                    img_element = img_flowables[0]
                 else:
                     img_table = Table([img_flowables], colWidths=[img_width, img_width], hAlign='CENTER', spaceAfter=0)
-                
-                img_table.setStyle(TableStyle([
-                    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                    ('LEFTPADDING', (0, 0), (-1, -1), 0),
-                    ('RIGHTPADDING', (0, 0), (-1, -1), 5),
-                    ('TOPPADDING', (0, 0), (-1, -1), 0),
-                    ('BOTTOMPADDING', (0, 0), (-1, -1), 0),
-                ]))
-                img_element = KeepInFrame(250, 190, [img_table], mode='shrink')
+                    img_table.setStyle(TableStyle([
+                        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+                        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+                        ('LEFTPADDING', (0, 0), (-1, -1), 0),
+                        ('RIGHTPADDING', (0, 0), (-1, -1), 5),
+                        ('TOPPADDING', (0, 0), (-1, -1), 0),
+                        ('BOTTOMPADDING', (0, 0), (-1, -1), 0),
+                    ]))
+                    img_element = KeepInFrame(250, 190, [img_table], mode='shrink')
             else:
-                img_element = Paragraph("No Image", ParagraphStyle('NoImage', alignment=1, fontSize=10, textColor=colors.grey))
+                img_element = Paragraph("No Image", no_image_style)
 
             desc = r.get('Description', '').strip()
             size = r.get('Size (mm)', '').strip()
@@ -1778,10 +1879,8 @@ def build_pdf_cached(data_hash, final_total, company_details,
             if size:
                 desc_parts.append(f"Size: {size}")
             full_desc = "<br/>".join(desc_parts) if desc_parts else "—"
-            
-            desc_style = ParagraphStyle('Desc', fontSize=11, leading=15, alignment=1, wordWrap='CJK')
+
             desc_para = Paragraph(full_desc, desc_style)
-            styleN = ParagraphStyle('Center', fontSize=10, leading=17, alignment=1)
             color_para = Paragraph(user_color, styleN)
 
             product_table_data.append([
@@ -1848,7 +1947,6 @@ def build_pdf_cached(data_hash, final_total, company_details,
         # ======================
         # Summary Table (same width)
         # ======================
-        subtotal = sum(float(item['Price per item']) * float(item['Quantity']) for item in data)
         discount_amount = subtotal - total
         vat = total * 0.14
         grand_total = total + vat
@@ -1908,12 +2006,12 @@ def build_pdf_cached(data_hash, final_total, company_details,
                 print(f"Error adding terms.png: {e}")
 
         # Now show the actual terms
-        terms_text = st.session_state.terms_and_conditions.get("value", "")
+        terms = st.session_state.terms_and_conditions
+        terms_text = terms.get("value", "")
         if terms_text:
-            import html
-            escaped_terms = html.escape(terms_text)
-            terms_html = "<br/>".join([f"{line.strip()}" for line in escaped_terms.split('\n') if line.strip()])
-            terms_para = Paragraph(f"<font size=12>{terms_html}</font>", aligned_style)
+            # Set when an admin saves the terms; the default text is converted on first use
+            terms_html = terms.get("html") or build_terms_html(terms_text)
+            terms_para = Paragraph(terms_html, get_terms_style())
             elems.append(Spacer(1, 20))
             elems.append(terms_para)
 
@@ -1926,72 +2024,18 @@ def build_pdf_cached(data_hash, final_total, company_details,
         except Exception as e:
             print(f"Error building PDF: {e}")
             raise
-        finally:
-            # Clean up temp image files
-            for temp_file in temp_files:
-                try:
-                    os.unlink(temp_file)
-                except:
-                    pass
 
-        return pdf_path
+        return pdf_buffer.getvalue()
 
-    # Ensure pdf_data is always in session state
-    st.session_state.pdf_data = st.session_state.get('pdf_data', [])
-
-    # Pass actual data (not empty list) to build_pdf
     return build_pdf(
-        st.session_state.pdf_data,
+        _data,
         final_total,
-        company_details,
+        subtotal,
+        _company_details,
         hdr_path,
         ftr_path
     )
 
-def load_user_history_from_sheet(user_email, sheet):
-    """Load user's quotation history from Google Sheet with fallbacks"""
-    if sheet is None:
-        return []
-    try:
-        df = get_as_dataframe(sheet)
-        df.dropna(how='all', inplace=True)  # Remove completely empty rows
-        user_rows = df[df["User Email"].str.lower() == user_email.lower()]
-        history = []
-        for _, row in user_rows.iterrows():
-            try:
-                items = json.loads(row["Items JSON"])
-                company_details_raw = row.get("Company Details JSON", "{}")
-                try:
-                    company_details = json.loads(company_details_raw) if pd.notna(company_details_raw) and company_details_raw.strip() != "" else {}
-                except:
-                    company_details = {}
-                # 🔐 Generate fallback hash if not present
-                stored_hash = str(row.get("Quotation Hash", "")).strip()
-                if not stored_hash or stored_hash.lower() == "nan":
-                    # Create deterministic fallback hash
-                    fallback_data = f"{row['Company Name']}{row['Timestamp']}{row['Total']}"
-                    stored_hash = hashlib.md5(fallback_data.encode()).hexdigest()
-                history.append({
-                    "user_email": row["User Email"],
-                    "timestamp": row["Timestamp"],
-                    "company_name": row["Company Name"],
-                    "contact_person": row["Contact Person"],
-                    "total": float(row["Total"]),
-                    "items": items,
-                    "pdf_filename": row["PDF Filename"],
-                    "hash": stored_hash,  # Always ensure this exists
-                    "company_details": company_details
-                })
-            except Exception as e:
-                st.warning(f"⚠ Skipping malformed row (Company: {row.get('Company Name', 'Unknown')}): {e}")
-                continue
-        return history
-    except Exception as e:
-        st.error(f"❌ Failed to load history: {e}")
-        return []
-
-
-
 
 # Shared Modal: Editable for Admin, Read-only for Buyer
 if st.session_state.get("show_edit_terms", False):
@@ -2014,6 +2058,7 @@ if st.session_state.get("show_edit_terms", False):
             with col1:
                 if st.form_submit_button("✅ Save Terms"):
                     st.session_state.terms_and_conditions["value"] = new_terms.strip()
+                    st.session_state.terms_and_conditions["html"] = build_terms_html(new_terms.strip())
                     st.session_state.terms_reviewed = terms_reviewed
                     st.session_state.show_edit_terms = False
                     st.success("✅ Terms updated!")
@@ -2086,66 +2131,90 @@ if st.button("📅 Generate PDF Quotation") and output_data:
         st.stop()
 
     with st.spinner("Generating PDF"):
-        st.session_state.pdf_data = output_data
-        data_str = str(output_data) + str(final_total) + str(company_details)
-        data_hash = hashlib.md5(data_str.encode()).hexdigest()
-        pdf_filename = f"{company_details['company_name']}{datetime.now().strftime('%Y%m%d%H%M')}.pdf"
-        pdf_file = build_pdf_cached(data_hash, final_total, company_details)
-        
-        # 👉 Prepare record
-        new_record = {
-            "user_email": st.session_state.user_email,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M"),
-            "company_name": company_details["company_name"],
-            "contact_person": company_details["contact_person"],
-            "total": round(final_total, 2),
-            "items": output_data.copy(),
-            "pdf_filename": pdf_filename,
-            "quotation_hash": data_hash
-        }
-        
-        # 👉 Save to session state
-        st.session_state.history.append(new_record)
-        
-        # 👉 Save to Google Sheet
-        history_sheet = get_history_sheet()
-        if history_sheet:
-            try:
-                import json
-                row = [
-                    new_record["user_email"],
-                    new_record["timestamp"],
-                    new_record["company_name"],
-                    new_record["contact_person"],
-                    new_record["total"],
-                    json.dumps(new_record["items"]),
-                    new_record["pdf_filename"],
-                    new_record["quotation_hash"]
-                ]
-                history_sheet.append_row(row)
-                st.success("✅ Quotation saved to session and Google Sheet!")
-            except Exception as e:
-                st.warning(f"⚠ Saved locally, but failed to save to Google Sheet: {e}")
+        # Hash piece by piece; sorted keys keep the hash independent of dict order
+        hasher = hashlib.blake2b(digest_size=16, usedforsecurity=False)
+        for item in output_data:
+            hasher.update(orjson.dumps(item, option=orjson.OPT_SORT_KEYS))
+        hasher.update(f"{final_total:.2f}".encode())
+        hasher.update(orjson.dumps(company_details, option=orjson.OPT_SORT_KEYS))
+        data_hash = hasher.hexdigest()
+        # data_hash covers every row field (incl. description, size and image,
+        # which can change in the product sheet) plus totals and company details;
+        # the rest of the key is what the PDF shows beyond those
+        pdf_cache_key = (
+            data_hash,
+            overall_discount,
+            tuple((s["text"], s["position"], s.get("color_name"), s.get("show")) for s in st.session_state.section_rows),
+            st.session_state.terms_and_conditions.get("value", ""),
+        )
+        last_pdf = st.session_state.get("last_pdf") or {}
+        if last_pdf.get("hash") == data_hash and last_pdf.get("cache_key") == pdf_cache_key:
+            # Same quotation as the last click: reuse its PDF, and only retry the
+            # sheet write if the last attempt failed
+            pdf_bytes = last_pdf["bytes"]
+            pdf_filename = last_pdf["filename"]
+            new_record = None if last_pdf.get("saved") else last_pdf.get("record")
         else:
-            st.warning("⚠ Could not connect to Google Sheet. Quotation saved locally only.")
+            pdf_filename = f"{company_details['company_name']}{datetime.now().strftime('%Y%m%d%H%M')}.pdf"
+            pdf_bytes = build_pdf_cached(pdf_cache_key, output_data, final_total, basePrice, company_details)
         
-        history_sheet = get_history_sheet()
-        if history_sheet:
-            st.session_state.history = load_user_history_from_sheet(st.session_state.user_email, history_sheet)
-            st.success("✅ History refreshed from Google Sheet!")
-        else:
-            st.error("Failed to connect to Google Sheets.")
+            # 👉 Prepare record (same shape as rows loaded by load_user_history_from_sheet)
+            new_record = {
+                "user_email": st.session_state.user_email,
+                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M"),
+                "company_name": company_details["company_name"],
+                "contact_person": company_details["contact_person"],
+                "total": round(final_total, 2),
+                "items": output_data.copy(),
+                "pdf_filename": pdf_filename,
+                "hash": data_hash,
+                "company_details": dict(company_details)
+            }
         
-        # Offer download
-        with open(pdf_file, "rb") as f:
-            st.download_button(
-                label="⬇ Click to Download PDF",
-                data=f,
-                file_name=pdf_filename,
-                mime="application/pdf",
-                key=f"download_pdf_{data_hash}"
+            # 👉 Save to session state (authoritative until the next explicit refresh)
+            st.session_state.history.append(new_record)
+
+            st.session_state.last_pdf = {
+                "hash": data_hash,
+                "cache_key": pdf_cache_key,
+                "bytes": pdf_bytes,
+                "filename": pdf_filename,
+                "record": new_record,
+                "saved": False
+            }
 
-            )
+        # 👉 Save to Google Sheet (a failed save is retried on the next Generate click)
+        if new_record is not None:
+            history_sheet = get_history_sheet()
+            if history_sheet:
+                try:
+                    row = [
+                        new_record["user_email"],
+                        new_record["timestamp"],
+                        new_record["company_name"],
+                        new_record["contact_person"],
+                        new_record["total"],
+                        orjson.dumps(new_record["items"]).decode(),
+                        new_record["pdf_filename"],
+                        new_record["hash"]
+                    ]
+                    history_sheet.append_rows([row])
+                    load_user_history_from_sheet.clear()
+                    st.session_state.last_pdf["saved"] = True
+                    st.success("✅ Quotation saved to session and Google Sheet!")
+                except Exception as e:
+                    st.warning(f"⚠ Saved locally, but failed to save to Google Sheet: {e}")
+            else:
+                st.warning("⚠ Could not connect to Google Sheet. Quotation saved locally only.")
+
+        # Offer download
+        st.download_button(
+            label="⬇ Click to Download PDF",
+            data=pdf_bytes,
+            file_name=pdf_filename,
+            mime="application/pdf",
+            key=f"download_pdf_{data_hash}"
+        )
 
 
 
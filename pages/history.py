@@ -3,33 +3,24 @@ import pandas as pd
 import hashlib
 import math
 from datetime import datetime
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Spacer, Paragraph, Image as RLImage
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Spacer, Paragraph, PageBreak, Image as RLImage
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.pagesizes import A3
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_CENTER
-# from reportlatypus import PageBreak
 from io import BytesIO
 import requests
+from requests.adapters import HTTPAdapter
 import tempfile
 import os
 import re
 from PIL import Image as PILImage
 import time
 import gspread
-from gspread_dataframe import get_as_dataframe
-import json
+import orjson
 from pathlib import Path
-
-
-# Helper function to safely convert any value to lowercase string
-def safe_lower(value):
-    """Safely convert any value to lowercase string, handling None and NaN values"""
-    if value is None:
-        return ""
-    if isinstance(value, float) and math.isnan(value):
-        return ""
-    return str(value).lower()
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 # ========== Page Config ==========
 st.set_page_config(page_title="Quotation History", page_icon="📜", layout="wide")
@@ -69,32 +60,40 @@ def load_user_history_from_sheet(user_email, sheet):
     if sheet is None:
         return []
     try:
-        df = get_as_dataframe(sheet)
-        df.dropna(how='all', inplace=True)  # Remove completely empty rows
-        user_rows = df[df["User Email"].str.lower() == user_email.lower()]
+        # Raw cell text in one call; only the user's rows are parsed further
+        values = sheet.get_all_values()
+        if not values:
+            return []
+        headers = [h.strip() for h in values[0]]
+        email_idx = headers.index("User Email")
+        user_email = user_email.lower()
         history = []
-        for _, row in user_rows.iterrows():
+        for raw_row in values[1:]:
+            if len(raw_row) <= email_idx or raw_row[email_idx].strip().lower() != user_email:
+                continue
+            row = dict(zip(headers, raw_row))
             try:
-                items = json.loads(row["Items JSON"])
-                company_details_raw = row.get("Company Details JSON", "{}")
+                items = orjson.loads(row["Items JSON"])
+                company_details_raw = row.get("Company Details JSON", "")
                 try:
-                    company_details = json.loads(company_details_raw) if pd.notna(company_details_raw) and company_details_raw.strip() != "" else {}
+                    company_details = orjson.loads(company_details_raw) if company_details_raw.strip() != "" else {}
                 except:
                     company_details = {}
 
                 # 🔐 Ensure a valid hash exists
-                stored_hash = str(row.get("Quotation Hash", "")).strip()
-                if pd.isna(row.get("Quotation Hash")) or not stored_hash or stored_hash.lower() in ("nan", "none", "null", ""):
+                stored_hash = row.get("Quotation Hash", "").strip()
+                if stored_hash.lower() in ("nan", "none", "null", ""):
                     # Fallback: deterministic hash from key fields
                     fallback_data = f"{row['Company Name']}{row['Timestamp']}{row['Total']}"
-                    stored_hash = hashlib.md5(fallback_data.encode()).hexdigest()
+                    stored_hash = hashlib.blake2b(fallback_data.encode(), digest_size=16, usedforsecurity=False).hexdigest()
 
                 history.append({
                   "user_email": row["User Email"],
                   "timestamp": row["Timestamp"],
                   "company_name": row["Company Name"],
+                  "company_name_lc": row["Company Name"].lower(),  # Lower-cased once for search
                   "contact_person": row["Contact Person"],
-                  "total": float(row["Total"]),
+                  "total": float(row["Total"].replace(",", "")),
                   "items": items,
                   "pdf_filename": row["PDF Filename"],
                   "hash": stored_hash,  # ← Guaranteed to exist
@@ -108,85 +107,191 @@ def load_user_history_from_sheet(user_email, sheet):
         st.error(f"❌ Failed to load history: {e}")
         return []
 
-def save_quotation_to_sheet(quote, sheet):
+@st.cache_data(ttl=60, show_spinner=False)
+def _cached_history(user_email):
+    """User's history from the sheet, cached for 60s; cleared on Refresh and Delete"""
+    return load_user_history_from_sheet(user_email, get_history_sheet())
+
+def save_quotations_to_sheet(quotes, sheet):
     """
-    Save a quotation record to Google Sheet
-    quote: dict (same structure as st.session_state.history item)
+    Save quotation records to Google Sheet in a single append call
+    quotes: list of dicts (same structure as st.session_state.history items)
     sheet: gspread worksheet object
     """
-    row = [
-        quote["user_email"],
-        quote["timestamp"],
-        quote["company_name"],
-        quote["contact_person"],
-        f"{quote['total']:.2f}",
-        json.dumps(quote["items"]),
-        json.dumps(quote.get("company_details", {})),
-        quote["pdf_filename"],
-        quote["hash"]
+    rows = [
+        [
+            quote["user_email"],
+            quote["timestamp"],
+            quote["company_name"],
+            quote["contact_person"],
+            f"{quote['total']:.2f}",
+            orjson.dumps(quote["items"]).decode(),
+            orjson.dumps(quote.get("company_details", {})).decode(),
+            quote["pdf_filename"],
+            quote["hash"]
+        ]
+        for quote in quotes
     ]
+    if not rows:
+        return True
     try:
-        sheet.append_row(row)
+        sheet.append_rows(rows)
         return True
     except Exception as e:
         st.error(f"❌ Failed to save to Google Sheet: {e}")
         return False
 
+def save_quotation_to_sheet(quote, sheet):
+    """Save a single quotation record to Google Sheet"""
+    return save_quotations_to_sheet([quote], sheet)
+
 # ========== Google Drive URL Conversion ==========
+DRIVE_VIEW_RE = re.compile(r'https://drive\.google\.com/file/d/([a-zA-Z0-9_-]+)/view')
+DRIVE_FILE_ID_RE = re.compile(r'/file/d/([a-zA-Z0-9_-]+)|[?&]id=([a-zA-Z0-9_-]+)')
+
 def convert_google_drive_url_for_storage(url):
     """Convert Google Drive view URL to direct download URL."""
     if not url or pd.isna(url):
         return url
-    drive_pattern = r'https://drive\.google\.com/file/d/([a-zA-Z0-9_-]+)/view'
-    match = re.search(drive_pattern, str(url))
+    # Non-Drive (already direct) URLs skip the regex entirely
+    if "drive.google.com" not in str(url):
+        return url
+    match = DRIVE_VIEW_RE.search(str(url))
     if match:
         file_id = match.group(1)
         return f"https://drive.google.com/uc?export=download&id={file_id}"
     return url
 
-def download_image_for_pdf(url, max_size=(300, 300)):
-    """Download and resize image for PDF embedding."""
+# Resized product images, shared with the builder page (same directory,
+# naming and TTL as IMAGE_CACHE_DIR in QuotationAppAmjad.py)
+IMAGE_CACHE_DIR = os.path.join(tempfile.gettempdir(), "amjad_pdf_images")
+IMAGE_CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+
+def image_cache_path(url, max_size):
+    """Cache file for a resized image: Drive file_id when there is one, else a hash of the URL."""
+    match = DRIVE_FILE_ID_RE.search(str(url)) if "drive.google.com" in str(url) else None
+    key = (match.group(1) or match.group(2)) if match else hashlib.sha1(str(url).encode()).hexdigest()
+    return os.path.join(IMAGE_CACHE_DIR, f"{key}_{max_size[0]}x{max_size[1]}.png")
+
+def is_image_cache_fresh(cache_path):
+    """True if the cached image exists and is younger than IMAGE_CACHE_TTL."""
+    try:
+        return time.time() - os.path.getmtime(cache_path) < IMAGE_CACHE_TTL
+    except OSError:
+        return False
+
+@st.cache_resource
+def get_http_session():
+    """Pooled HTTP session shared by image downloads, so keep-alive connections are reused"""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=16))
+    session.headers["User-Agent"] = "Mozilla/5.0 (compatible; AmjadQuotation/1.0)"
+    return session
+
+def fetch_image_bytes(url, max_size, session):
+    """Fetch image bytes, preferring Drive's server-side thumbnail at the target size."""
+    match = DRIVE_FILE_ID_RE.search(str(url)) if "drive.google.com" in str(url) else None
+    if match:
+        file_id = match.group(1) or match.group(2)
+        thumbnail_url = f"https://drive.google.com/thumbnail?id={file_id}&sz=w{max_size[0]}-h{max_size[1]}"
+        try:
+            thumbnail = session.get(thumbnail_url, timeout=5)
+            if thumbnail.ok and thumbnail.headers.get("Content-Type", "").startswith("image/"):
+                return thumbnail.content
+        except requests.exceptions.RequestException:
+            pass  # Fall back to the full-size download below
+    response = session.get(url, timeout=5)
+    response.raise_for_status()
+    return response.content
+
+def download_image_for_pdf(url, session, max_size=(300, 300)):
+    """Download and resize image for PDF embedding, returning PNG bytes and reusing the on-disk cache."""
+    cache_path = image_cache_path(url, max_size)
     try:
-        response = requests.get(url, timeout=5)
-        response.raise_for_status()
-        img = PILImage.open(BytesIO(response.content)).convert("RGB")
-        img_ratio = img.width / img.height
+        if is_image_cache_fresh(cache_path):
+            with open(cache_path, "rb") as cached:
+                return cached.read()
+        content = fetch_image_bytes(url, max_size, session)
+        img = PILImage.open(BytesIO(content))
         max_width, max_height = max_size
-        if img.width > max_width or img.height > max_height:
-            if img_ratio > 1:
-                new_width = max_width
-                new_height = int(max_width / img_ratio)
+        fits = img.width <= max_width and img.height <= max_height
+        # An RGB PNG that already fits is stored as downloaded, with no decode or re-encode
+        store_raw = fits and img.format == "PNG" and img.mode == "RGB"
+        if not store_raw:
+            # Flatten transparency onto white, as the builder page does, so both
+            # pages write interchangeable files into the shared cache
+            if img.mode in ('RGBA', 'LA', 'P'):
+                if img.mode == 'P':
+                    img = img.convert('RGBA')
+                background = PILImage.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+                img = background
             else:
-                new_height = max_height
-                new_width = int(max_height * img_ratio)
-            img = img.resize((new_width, new_height), PILImage.Resampling.LANCZOS)
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-        img.save(temp_file, format="PNG")
+                img = img.convert("RGB")
+            img_ratio = img.width / img.height
+            if not fits:
+                if img_ratio > 1:
+                    new_width = max_width
+                    new_height = int(max_width / img_ratio)
+                else:
+                    new_height = max_height
+                    new_width = int(max_height * img_ratio)
+                img = img.resize((new_width, new_height), PILImage.Resampling.LANCZOS)
+        if store_raw:
+            png_bytes = content
+        else:
+            buffer = BytesIO()
+            img.save(buffer, format="PNG")
+            png_bytes = buffer.getvalue()
+        # Write beside the cache file and rename so readers never see a partial PNG
+        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png", dir=IMAGE_CACHE_DIR)
+        temp_file.write(png_bytes)
         temp_file.close()
-        return temp_file.name
+        os.replace(temp_file.name, cache_path)
+        return png_bytes
     except Exception as e:
         print(f"Image download/resize failed: {e}")
         return None
 
-def generate_pdf_from_data(items, total, company_details, hdr_path="q2.png", ftr_path="footer (1).png"):
-    """Generate a professional PDF with conditional discount display."""
-    def build_pdf(data, total, company_details, hdr_path, ftr_path):
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-        pdf_path = tmp.name
-        tmp.close()
-        doc = SimpleDocTemplate(
-            pdf_path,
-            pagesize=A3,
-            topMargin=230,
-            leftMargin=40,
-            rightMargin=40,
-            bottomMargin=250
-        )
-        styles = getSampleStyleSheet()
-        elems = []
-        styles['Normal'].fontSize = 14
-        styles['Normal'].leading = 20
-        aligned_style = ParagraphStyle(
+# Regenerated PDFs, named by quotation hash; only the most recently used
+# PDF_CACHE_MAX_FILES are kept
+PDF_CACHE_DIR = os.path.join(tempfile.gettempdir(), "amjad_pdf_cache")
+PDF_CACHE_MAX_FILES = 50
+os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+
+def pdf_cache_path(quote_hash):
+    """Cache file for a saved quotation's regenerated PDF"""
+    return os.path.join(PDF_CACHE_DIR, f"{quote_hash}.pdf")
+
+def prune_pdf_cache():
+    """Delete the least recently used cached PDFs beyond PDF_CACHE_MAX_FILES"""
+    entries = []
+    for entry in os.scandir(PDF_CACHE_DIR):
+        try:
+            entries.append((entry.stat().st_mtime, entry.path))
+        except OSError:
+            continue
+    entries.sort(reverse=True)
+    for _, path in entries[PDF_CACHE_MAX_FILES:]:
+        Path(path).unlink(missing_ok=True)
+
+@st.cache_data(show_spinner=False)
+def get_pdf_image_size(path):
+    """Read a header/footer image's (width, height) once; drawImage gets the path so ReportLab embeds it once per PDF"""
+    if not path or not os.path.exists(path):
+        return None
+    with PILImage.open(path) as img:
+        return img.size
+
+@st.cache_resource
+def get_pdf_styles():
+    """Paragraph and table styles shared by every regenerated PDF"""
+    styles = getSampleStyleSheet()
+    styles['Normal'].fontSize = 14
+    styles['Normal'].leading = 20
+    return {
+        "aligned": ParagraphStyle(
             name='LeftAligned',
             parent=styles['Normal'],
             leftIndent=0,
@@ -194,141 +299,10 @@ def generate_pdf_from_data(items, total, company_details, hdr_path="q2.png", ftr
             alignment=0,
             spaceBefore=12,
             spaceAfter=12
-        )
-
-        def header_footer(canvas, doc):
-            canvas.saveState()
-            # Header
-            if hdr_path and os.path.exists(hdr_path):
-                img = PILImage.open(hdr_path)
-                w, h = img.size
-                img_w = doc.width + doc.leftMargin + doc.rightMargin
-                img_h = img_w * (h / w)
-                canvas.drawImage(hdr_path, 0, A3[1] - img_h + 10, width=img_w, height=img_h)
-            # Footer
-            footer_height = 0
-            if ftr_path and os.path.exists(ftr_path):
-                img2 = PILImage.open(ftr_path)
-                w2, h2 = img2.size
-                img_w2 = doc.width + doc.leftMargin + doc.rightMargin
-                img_h2 = img_w2 * (h2 / w2)
-                canvas.drawImage(ftr_path, 0, 1, width=img_w2, height=img_h2)
-                footer_height = img_h2
-            # Page number
-            canvas.setFont('Helvetica', 10)
-            page_num = canvas.getPageNumber()
-            canvas.drawRightString(doc.width + doc.leftMargin, footer_height + 10, str(page_num))
-            canvas.restoreState()
-
-        # Company & Contact Details
-        detail_lines = [
-            "<para align='left'>",
-            "<font size=14>",
-            "<b>Company Address:</b> <font color='black'>Al Salam First, Cairo Governorate, Al Qahirah, Cairo</font><br/>",
-            "<b>Company Phone:</b> <font color='black'>01025780717</font><br/><br/>",
-            f"<b>Date:</b> <font color='black'>{company_details['current_date']}</font><br/>",
-            f"<b>Valid Till:</b> <font color='black'>{company_details['valid_till']}</font><br/>",
-            f"<b>Quotation Validity:</b> <font color='black'>{company_details['quotation_validity']}</font><br/>",
-            f"<b>Prepared By:</b> <font color='black'>{company_details['prepared_by']}</font><br/>",
-            f"<b>Email:</b> <font color='black'>{company_details['prepared_by_email']}</font><br/><br/>",
-            f"<b>Contact Person:</b> <font color='black'>{company_details['contact_person']}</font><br/>",
-            f"<b>Company Name:</b> <font color='black'>{company_details['company_name']}</font><br/>",
-        ]
-        if company_details.get("address"):
-            detail_lines.append(f"<b>Address:</b> <font color='black'>{company_details['address']}</font><br/>")
-        detail_lines.append(f"<b>Cell Phone:</b> <font color='black'>{company_details['contact_phone']}</font><br/>")
-        if company_details.get("contact_email"):
-            detail_lines.append(f"<b>Contact Email:</b> <font color='black'>{company_details['contact_email']}</font><br/>")
-        detail_lines.append("</font>")
-        detail_lines.append("</para>")
-        details = "".join(detail_lines)
-        elems.append(Spacer(1, 40))
-        elems.append(Paragraph(details, aligned_style))
-
-        # Terms & Conditions
-        terms_conditions = f"""
-        <para align="left">
-        <font size=14>
-        <b>Terms and Conditions:</b><br/>
-        • Warranty: {company_details['warranty']}<br/>
-        • Down payment: {company_details['down_payment']}% of the total invoice<br/>
-        • Delivery: {company_details['delivery']}<br/>
-        • {company_details['vat_note']}<br/>
-        • {company_details['shipping_note']}<br/>
-        </font>
-        </para>
-        """
-        elems.append(Paragraph(terms_conditions, aligned_style))
-
-        # Payment Info
-        payment_info = f"""
-        <para align="left">
-        <font size=14>
-        <b>Payment Info:</b><br/>
-        <b>Bank:</b> <font color="black">{company_details['bank']}</font><br/>
-        <b>IBAN:</b> <font color="black">{company_details['iban']}</font><br/>
-        <b>Account Number:</b> <font color="black">{company_details['account_number']}</font><br/>
-        <b>Company:</b> <font color="black">{company_details['company']}</font><br/>
-        <b>Tax ID:</b> <font color="black">{company_details['tax_id']}</font><br/>
-        <b>Commercial/Chamber Reg. No:</b> <font color="black">{company_details['reg_no']}</font>
-        </font>
-        </para>
-        """
-        elems.append(Paragraph(payment_info, aligned_style))
-        elems.append(Spacer(1, 90))
-        elems.append(PageBreak())
-
-        # Table styles
-        desc_style = ParagraphStyle(name='Description', fontSize=12, leading=16, alignment=TA_CENTER)
-        styleN = ParagraphStyle(name='Normal', fontSize=12, leading=12, alignment=TA_CENTER)
-
-        def is_empty(val):
-            return pd.isna(val) or val is None or str(val).lower() in ['nan', 'n/a', '']
-
-        def safe_str(val):
-            return "" if is_empty(val) else str(val)
-
-        def safe_float(val):
-            return "" if is_empty(val) else f"{float(val):.2f}"
-
-        product_table_data = [["Ser.", "Product", "Image", "SKU", "Details", "QTY", "Unit Price", "Line Total"]]
-        temp_files = []
-
-        for idx, r in enumerate(items, start=1):
-            img_element = "No Image"
-            if r.get("Image"):
-                download_url = convert_google_drive_url_for_storage(r["Image"])
-                temp_img_path = download_image_for_pdf(download_url, max_size=(300, 300))
-                if temp_img_path:
-                    try:
-                        img = RLImage(temp_img_path)
-                        img._restrictSize(190, 180)
-                        img.hAlign = 'CENTER'
-                        img.vAlign = 'MIDDLE'
-                        img_element = img
-                        temp_files.append(temp_img_path)
-                    except Exception as e:
-                        print(f"Error creating image element: {e}")
-
-            details_text = (
-                f"<b>Description:</b> {safe_str(r.get('Description'))}<br/>"
-                f"<b>Color:</b> {safe_str(r.get('Color'))}<br/>"
-                f"<b>Warranty:</b> {safe_str(r.get('Warranty'))}"
-            )
-            details_para = Paragraph(details_text, desc_style)
-            product_table_data.append([
-                str(idx),
-                Paragraph(safe_str(r.get('Item')), styleN),
-                img_element,
-                Paragraph(safe_str(r.get('SKU')).upper(), styleN),
-                details_para,
-                Paragraph(safe_str(r.get('Quantity')), styleN),
-                Paragraph(safe_float(r.get('Price per item')), styleN),
-                Paragraph(safe_float(r.get('Total price')), styleN),
-            ])
-
-        product_table = Table(product_table_data, colWidths=[30, 100, 150, 60, 200, 30, 60, 60])
-        product_table.setStyle(TableStyle([
+        ),
+        "desc": ParagraphStyle(name='Description', fontSize=12, leading=16, alignment=TA_CENTER),
+        "cell": ParagraphStyle(name='Normal', fontSize=12, leading=12, alignment=TA_CENTER),
+        "product_table": TableStyle([
             ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
             ('FONTSIZE', (0, 0), (-1, 0), 12),
             ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
@@ -343,49 +317,224 @@ def generate_pdf_from_data(items, total, company_details, hdr_path="q2.png", ftr
             ('RIGHTPADDING', (0, 0), (-1, -1), 6),
             ('TOPPADDING', (0, 0), (-1, -1), 6),
             ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-        ]))
-        elems.append(product_table)
-
-        # === Summary Section with Conditional Discount ===
-        subtotal = sum(float(r.get('Price per item', 0)) * float(r.get('Quantity', 1)) for r in items)
-        total_after_discount = total
-        discount_amount = subtotal - total_after_discount
-        vat = total_after_discount * 0.15
-        grand_total = total_after_discount + vat
-
-        summary_data = [
-            ["Total", f"{subtotal:.2f} EGP"]
-        ]
-        if discount_amount > 0:
-            summary_data.append(["Special Discount", f"- {discount_amount:.2f} EGP"])
-        summary_data.append(["Total After Discount", f"{total_after_discount:.2f} EGP"])
-        summary_data.append(["VAT (15%)", f"{vat:.2f} EGP"])
-        summary_data.append(["Grand Total", f"{grand_total:.2f} EGP"])
-
-        col_widths = [615, 150] if discount_amount > 0 else [540, 150]
-        summary_table = Table(summary_data, colWidths=col_widths)
-        summary_table.setStyle(TableStyle([
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 12),
-            ('GRID', (0, 0), (-1, -1), 1.0, colors.black),
-            ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),
-            ('TEXTCOLOR', (1, 1), (1, 1), colors.red) if discount_amount > 0 else ('TEXTCOLOR', (1, 1), (1, 1), colors.black),
-        ]))
-        elems.append(summary_table)
+        ]),
+    }
 
-        try:
-            doc.build(elems, onFirstPage=header_footer, onLaterPages=header_footer)
-        finally:
-            for temp_file in temp_files:
-                try:
-                    os.unlink(temp_file)
-                except:
-                    pass
-        return pdf_path
+def clean_cell(val):
+    """Text for a PDF table cell; None, NaN, "nan" and "n/a" become ""."""
+    if val is None or (isinstance(val, float) and math.isnan(val)):
+        return ""
+    text = str(val)
+    return "" if text.lower() in ("", "nan", "n/a") else text
 
-    return build_pdf(items, total, company_details, hdr_path, ftr_path)
+def parse_number(val, default):
+    """Numeric value of a cell, or default when it is blank or not a number."""
+    text = clean_cell(val).strip()
+    try:
+        return float(text) if text else default
+    except ValueError:
+        return default
+
+def format_price(val):
+    """Price cell with two decimals, or "" when it is blank or not a number."""
+    number = parse_number(val, None)
+    return "" if number is None else f"{number:.2f}"
+
+def draw_header_footer(canvas, doc, hdr_path, ftr_path, hdr_size, ftr_size):
+    """Draw the header/footer images and the page number on one PDF page."""
+    canvas.saveState()
+    page_w = doc.width + doc.leftMargin + doc.rightMargin
+    # Header
+    if hdr_size is not None:
+        w, h = hdr_size
+        img_h = page_w * (h / w)
+        canvas.drawImage(hdr_path, 0, A3[1] - img_h + 10, width=page_w, height=img_h)
+    # Footer
+    footer_height = 0
+    if ftr_size is not None:
+        w2, h2 = ftr_size
+        img_h2 = page_w * (h2 / w2)
+        canvas.drawImage(ftr_path, 0, 1, width=page_w, height=img_h2)
+        footer_height = img_h2
+    # Page number
+    canvas.setFont('Helvetica', 10)
+    page_num = canvas.getPageNumber()
+    canvas.drawRightString(doc.width + doc.leftMargin, footer_height + 10, str(page_num))
+    canvas.restoreState()
+
+def generate_pdf_from_data(items, total, company_details, hdr_path="q2.png", ftr_path="footer (1).png"):
+    """Generate a professional PDF with conditional discount display, returning its temp file path."""
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
+    pdf_path = tmp.name
+    tmp.close()
+    doc = SimpleDocTemplate(
+        pdf_path,
+        pagesize=A3,
+        topMargin=230,
+        leftMargin=40,
+        rightMargin=40,
+        bottomMargin=250
+    )
+    pdf_styles = get_pdf_styles()
+    aligned_style = pdf_styles["aligned"]
+    elems = []
+
+    # Header/footer sizes are read once; the images go to drawImage by path so
+    # ReportLab embeds each one once per document
+    header_footer = partial(
+        draw_header_footer,
+        hdr_path=hdr_path,
+        ftr_path=ftr_path,
+        hdr_size=get_pdf_image_size(hdr_path),
+        ftr_size=get_pdf_image_size(ftr_path)
+    )
+
+    # Company & Contact Details
+    detail_lines = [
+        "<para align='left'>",
+        "<font size=14>",
+        "<b>Company Address:</b> <font color='black'>Al Salam First, Cairo Governorate, Al Qahirah, Cairo</font><br/>",
+        "<b>Company Phone:</b> <font color='black'>01025780717</font><br/><br/>",
+        f"<b>Date:</b> <font color='black'>{company_details['current_date']}</font><br/>",
+        f"<b>Valid Till:</b> <font color='black'>{company_details['valid_till']}</font><br/>",
+        f"<b>Quotation Validity:</b> <font color='black'>{company_details['quotation_validity']}</font><br/>",
+        f"<b>Prepared By:</b> <font color='black'>{company_details['prepared_by']}</font><br/>",
+        f"<b>Email:</b> <font color='black'>{company_details['prepared_by_email']}</font><br/><br/>",
+        f"<b>Contact Person:</b> <font color='black'>{company_details['contact_person']}</font><br/>",
+        f"<b>Company Name:</b> <font color='black'>{company_details['company_name']}</font><br/>",
+    ]
+    if company_details.get("address"):
+        detail_lines.append(f"<b>Address:</b> <font color='black'>{company_details['address']}</font><br/>")
+    detail_lines.append(f"<b>Cell Phone:</b> <font color='black'>{company_details['contact_phone']}</font><br/>")
+    if company_details.get("contact_email"):
+        detail_lines.append(f"<b>Contact Email:</b> <font color='black'>{company_details['contact_email']}</font><br/>")
+    detail_lines.append("</font>")
+    detail_lines.append("</para>")
+    details = "".join(detail_lines)
+    elems.append(Spacer(1, 40))
+    elems.append(Paragraph(details, aligned_style))
+
+    # Terms & Conditions
+    terms_conditions = f"""
+    <para align="left">
+    <font size=14>
+    <b>Terms and Conditions:</b><br/>
+    • Warranty: {company_details['warranty']}<br/>
+    • Down payment: {company_details['down_payment']}% of the total invoice<br/>
+    • Delivery: {company_details['delivery']}<br/>
+    • {company_details['vat_note']}<br/>
+    • {company_details['shipping_note']}<br/>
+    </font>
+    </para>
+    """
+    elems.append(Paragraph(terms_conditions, aligned_style))
+
+    # Payment Info
+    payment_info = f"""
+    <para align="left">
+    <font size=14>
+    <b>Payment Info:</b><br/>
+    <b>Bank:</b> <font color="black">{company_details['bank']}</font><br/>
+    <b>IBAN:</b> <font color="black">{company_details['iban']}</font><br/>
+    <b>Account Number:</b> <font color="black">{company_details['account_number']}</font><br/>
+    <b>Company:</b> <font color="black">{company_details['company']}</font><br/>
+    <b>Tax ID:</b> <font color="black">{company_details['tax_id']}</font><br/>
+    <b>Commercial/Chamber Reg. No:</b> <font color="black">{company_details['reg_no']}</font>
+    </font>
+    </para>
+    """
+    elems.append(Paragraph(payment_info, aligned_style))
+    elems.append(Spacer(1, 90))
+    elems.append(PageBreak())
+
+    # Table styles
+    desc_style = pdf_styles["desc"]
+    styleN = pdf_styles["cell"]
+
+    product_table_data = [["Ser.", "Product", "Image", "SKU", "Details", "QTY", "Unit Price", "Line Total"]]
+
+    # Download each distinct product image concurrently (network-bound), then
+    # build the ReportLab flowables on this thread. The session is resolved here,
+    # on the script thread; worker threads have no Streamlit script context
+    session = get_http_session()
+    image_urls = [convert_google_drive_url_for_storage(r["Image"]) if r.get("Image") else None for r in items]
+    unique_urls = list(dict.fromkeys(url for url in image_urls if url))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        image_bytes_by_url = dict(zip(unique_urls, executor.map(
+            lambda url: download_image_for_pdf(url, session, max_size=(300, 300)),
+            unique_urls
+        )))
+    row_images = [image_bytes_by_url.get(url) for url in image_urls]
+
+    for idx, (r, image_bytes) in enumerate(zip(items, row_images), start=1):
+        img_element = "No Image"
+        if image_bytes:
+            try:
+                # Each flowable gets its own buffer; rows may share the same image bytes
+                img = RLImage(BytesIO(image_bytes))
+                img._restrictSize(190, 180)
+                img.hAlign = 'CENTER'
+                img.vAlign = 'MIDDLE'
+                img_element = img
+            except Exception as e:
+                print(f"Error creating image element: {e}")
+
+        details_text = (
+            f"<b>Description:</b> {clean_cell(r.get('Description'))}<br/>"
+            f"<b>Color:</b> {clean_cell(r.get('Color'))}<br/>"
+            f"<b>Warranty:</b> {clean_cell(r.get('Warranty'))}"
+        )
+        details_para = Paragraph(details_text, desc_style)
+        product_table_data.append([
+            str(idx),
+            Paragraph(clean_cell(r.get('Item')), styleN),
+            img_element,
+            clean_cell(r.get('SKU')).upper(),
+            details_para,
+            clean_cell(r.get('Quantity')),
+            format_price(r.get('Price per item')),
+            format_price(r.get('Total price')),
+        ])
+
+    product_table = Table(product_table_data, colWidths=[30, 100, 150, 60, 200, 30, 60, 60])
+    product_table.setStyle(pdf_styles["product_table"])
+    elems.append(product_table)
+
+    # === Summary Section with Conditional Discount ===
+    subtotal = sum(parse_number(r.get('Price per item'), 0) * parse_number(r.get('Quantity'), 1) for r in items)
+    total_after_discount = total
+    discount_amount = subtotal - total_after_discount
+    vat = total_after_discount * 0.15
+    grand_total = total_after_discount + vat
+
+    summary_data = [
+        ["Total", f"{subtotal:.2f} EGP"]
+    ]
+    if discount_amount > 0:
+        summary_data.append(["Special Discount", f"- {discount_amount:.2f} EGP"])
+    summary_data.append(["Total After Discount", f"{total_after_discount:.2f} EGP"])
+    summary_data.append(["VAT (15%)", f"{vat:.2f} EGP"])
+    summary_data.append(["Grand Total", f"{grand_total:.2f} EGP"])
+
+    col_widths = [615, 150] if discount_amount > 0 else [540, 150]
+    summary_table = Table(summary_data, colWidths=col_widths)
+    summary_table.setStyle(TableStyle([
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, -1), 12),
+        ('GRID', (0, 0), (-1, -1), 1.0, colors.black),
+        ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),
+        ('TEXTCOLOR', (1, 1), (1, 1), colors.red) if discount_amount > 0 else ('TEXTCOLOR', (1, 1), (1, 1), colors.black),
+    ]))
+    elems.append(summary_table)
+
+    doc.build(elems, onFirstPage=header_footer, onLaterPages=header_footer)
+    return pdf_path
+
+# ========== Load History ==========
+if not st.session_state.history:
+    st.session_state.history = _cached_history(st.session_state.user_email)
 
 # ========== Header ==========
 st.title("📜 Quotation History")
@@ -398,9 +547,10 @@ if st.button("⬅ Back to Quotation Builder"):
 # ========== Refresh Button ==========
 st.markdown("---")
 if st.button("🔄 Refresh History from Cloud"):
+    _cached_history.clear()
     history_sheet = get_history_sheet()
     if history_sheet:
-        st.session_state.history = load_user_history_from_sheet(st.session_state.user_email, history_sheet)
+        st.session_state.history = _cached_history(st.session_state.user_email)
         st.success("✅ History refreshed from Google Sheet!")
     else:
         st.error("Failed to connect to Google Sheets.")
@@ -419,8 +569,9 @@ with clear_col:
         st.rerun()
 
 if search_term:
-    filtered_history = [quote for quote in st.session_state.history 
-                       if search_term in safe_lower(quote['company_name'])]
+    # Names are lower-cased at load time; quotes added this session fall back to lowering here
+    filtered_history = [quote for quote in st.session_state.history
+                        if search_term in (quote.get('company_name_lc') or str(quote.get('company_name') or "").lower())]
     st.caption(f"Found {len(filtered_history)} quotation(s) matching your search")
 else:
     filtered_history = st.session_state.history
@@ -450,17 +601,34 @@ else:
                 if st.button(f"📄 Regenerate PDF", key=f"regen_{idx}_{quote_hash}"):
                     with st.spinner("Rebuilding PDF..."):
                         try:
-                            temp_details = quote.get("company_details") or st.session_state.company_details
-                            pdf_file = generate_pdf_from_data(quote["items"], quote["total"], temp_details)
+                            # Quotes without a stored hash are never cached: their
+                            # placeholder key is not unique across quotes or users
+                            cache_path = pdf_cache_path(quote["hash"]) if quote.get("hash") else None
+                            pdf_file = None
+                            if cache_path and os.path.exists(cache_path):
+                                os.utime(cache_path)  # Mark as recently used for pruning
+                                pdf_file = cache_path
+                            if pdf_file is None:
+                                temp_details = quote.get("company_details") or st.session_state.company_details
+                                pdf_file = generate_pdf_from_data(quote["items"], quote["total"], temp_details)
+                                # A saved quotation never changes, so later clicks can serve this file as-is
+                                # (unless it was built from the session's company details)
+                                if pdf_file and cache_path and quote.get("company_details"):
+                                    os.replace(pdf_file, cache_path)
+                                    pdf_file = cache_path
+                                    prune_pdf_cache()
                             if pdf_file:
                                 with open(pdf_file, "rb") as f:
-                                    st.download_button(
-                                        "⬇ Download PDF",
-                                        f,
-                                        file_name=quote["pdf_filename"],
-                                        mime="application/pdf",
-                                        key=f"dl_hist_{idx}"
-                                    )
+                                    pdf_bytes = f.read()
+                                if pdf_file != cache_path:
+                                    Path(pdf_file).unlink(missing_ok=True)
+                                st.download_button(
+                                    "⬇ Download PDF",
+                                    pdf_bytes,
+                                    file_name=quote["pdf_filename"],
+                                    mime="application/pdf",
+                                    key=f"dl_hist_{idx}"
+                                )
                         except Exception as e:
                             st.error(f"Failed to generate PDF: {e}")
 
@@ -475,19 +643,19 @@ else:
                             if history_sheet is None:
                                 st.error("❌ Cannot connect to Google Sheet.")
                             else:
-                                # Load all data from sheet
-                                df = get_as_dataframe(history_sheet)
-                                df.dropna(how='all', inplace=True)
+                                # Fetch only the header row and the Quotation Hash column
+                                headers = [h.strip() for h in history_sheet.row_values(1)]
+                                hashes = history_sheet.col_values(headers.index("Quotation Hash") + 1) if "Quotation Hash" in headers else []
 
-                                # Find row where Quotation Hash matches
-                                matching_rows = df[df["Quotation Hash"] == quote["hash"]]
+                                # Find row where Quotation Hash matches (Google Sheets rows are 1-indexed, header is row 1)
+                                row_index = next((i for i, h in enumerate(hashes[1:], start=2) if h == quote["hash"]), None)
 
-                                if len(matching_rows) == 0:
+                                if row_index is None:
                                     st.warning("⚠ This quotation was not found in the Google Sheet.")
                                 else:
-                                    # Get the first matching row index (Google Sheets is 1-indexed, +2 for header and 0-index)
-                                    row_index = matching_rows.index[0] + 2  # +2 because: 0-index + 1 header row
-                                    history_sheet.delete_rows(int(row_index))
+                                    history_sheet.delete_rows(row_index)
+                                    _cached_history.clear()
+                                    Path(pdf_cache_path(quote['hash'])).unlink(missing_ok=True)
                                     st.success("🗑 Quotation deleted from Google Sheet!")
 
                             # ✅ Remove from session state
@@ -510,6 +678,9 @@ else:
             # Edit Button
             with col3:
                 if st.button("✏ Edit Quotation", key=f"edit_{idx}_{quote['hash']}"):
+                    # The edited quotation gets a new hash; drop the old cached PDF
+                    Path(pdf_cache_path(quote['hash'])).unlink(missing_ok=True)
+
                     # Restore into session state
                     st.session_state.form_submitted = True
                     st.session_state.company_details = quote.get("company_details") or {